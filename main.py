@@ -1,152 +1,233 @@
+import gzip
+import hashlib
 import logging
 import os
-from typing import Optional
-
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Optional, Tuple
+
+import brotli
 import cloudscraper
-from flask import Flask, Response
+import requests
+from cloudscraper import CipherSuiteAdapter
+from flask import Flask, Response, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from lxml import etree, html
+from lxml import etree
+from urllib3.util.retry import Retry
+from werkzeug.http import http_date
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Set up logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=(
+        logging.DEBUG if os.environ.get("FLASK_ENV") == "development" else logging.INFO
+    ),
     format="%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s",
 )
 logger = logging.getLogger(__name__)
 
+FEED_URL = "https://www.iraqinews.com/feed/"
 
-def fetch_feed() -> Optional[str]:
-    """Fetch the original RSS feed from iraqinews.com"""
-    scraper = cloudscraper.create_scraper(
-        browser={"browser": "chrome", "platform": "darwin", "desktop": True}
-    )
+# Shared scraper so the Cloudflare setup and the TLS connection are reused
+SCRAPER = cloudscraper.create_scraper(
+    browser={"browser": "chrome", "platform": "darwin", "desktop": True}
+)
+# Re-mount cloudscraper's TLS adapter with a larger pool and retries
+SCRAPER.mount(
+    "https://",
+    CipherSuiteAdapter(
+        cipherSuite=SCRAPER.cipherSuite,
+        ecdhCurve=SCRAPER.ecdhCurve,
+        server_hostname=SCRAPER.server_hostname,
+        source_address=SCRAPER.source_address,
+        ssl_context=SCRAPER.ssl_context,
+        pool_connections=4,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ),
+)
 
-    url = "https://www.iraqinews.com/feed/"
+# Filtered feed cache, refreshed in the background every REFRESH_INTERVAL
+# seconds (every RETRY_INTERVAL until a feed is cached) and advertised to
+# clients with a CACHE_TTL max-age
+CACHE_TTL = 300
+REFRESH_INTERVAL = 180
+RETRY_INTERVAL = 10
+FETCH_TIMEOUT = 10
+CACHE_CONTROL = f"public, max-age={CACHE_TTL}"
+_CACHE = {
+    "etag": None,
+    "last_modified": None,
+    "last_modified_header": None,
+    "upstream_etag": None,
+    "upstream_last_modified": None,
+    "body": None,
+    "encoded": {},
+}
+_CACHE_LOCK = threading.Lock()
+# Set once the first background refresh attempt has finished
+_FIRST_REFRESH = threading.Event()
+
+# Upper bound on the upstream feed size, to bound parse time and memory
+MAX_FEED_BYTES = 2 * 1024 * 1024
+
+
+def read_limited(response: requests.Response) -> bytes:
+    """Read a streamed response body, refusing anything over MAX_FEED_BYTES"""
+    content = response.raw.read(MAX_FEED_BYTES + 1, decode_content=True)
+    if len(content) > MAX_FEED_BYTES:
+        raise ValueError(f"Feed is larger than {MAX_FEED_BYTES} bytes")
+    return content
+
+
+def fetch_feed(
+    etag: Optional[str] = None, last_modified: Optional[str] = None
+) -> Optional[Tuple[requests.Response, bytes]]:
+    """Fetch the original RSS feed from iraqinews.com
+
+    When an upstream ETag or Last-Modified value is given the request is
+    conditional, and a 304 response (returned with an empty body) means the
+    previously fetched feed is still current.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
 
     try:
-        logger.info(f"Fetching feed from {url}")
-        response = scraper.get(url, timeout=10)
-        response.raise_for_status()
-        logger.info(f"Successfully fetched feed (status code: {response.status_code})")
-        return response.text
+        logger.info("Fetching feed from %s", FEED_URL)
+        with SCRAPER.get(
+            FEED_URL, timeout=FETCH_TIMEOUT, headers=headers, stream=True
+        ) as response:
+            response.raise_for_status()
+            content = b"" if response.status_code == 304 else read_limited(response)
+        logger.info("Successfully fetched feed (status code: %s)", response.status_code)
+        return response, content
     except Exception as e:
-        logger.error(f"Failed to fetch feed: {str(e)}")
+        logger.error("Failed to fetch feed: %s", e)
         return None
 
 
-def create_cdata_element(tag: str, text: str, parent) -> etree._Element:
-    """Create an element with CDATA content with proper formatting"""
-    elem = etree.SubElement(parent, tag)
-    # Format CDATA content with proper newlines and spacing
-    formatted_text = f"\n{text}\n"
-    elem.text = etree.CDATA(formatted_text)
-    return elem
-
-
-def filter_feed(feed_content: str) -> str:
-    """Filter the feed to keep only Iraq-related articles"""
-    # Parse the feed with lxml
-    parser = etree.XMLParser(strip_cdata=False, remove_blank_text=True, recover=True)
-    root = etree.fromstring(feed_content.encode("utf-8"), parser)
-
-    # Find all items
-    items = root.findall(".//item")
-    channel = root.find("channel")
-
-    if channel is None:
-        logger.error("Invalid feed format: no channel element found")
-        return feed_content
-
-    # Remove all items from channel
-    for item in items:
-        parent = item.getparent()
-        if parent is not None:
-            parent.remove(item)
+# Iraq articles live under this path; the bytes pattern pre-scans the raw
+# feed, where its absence means no item can match and link checks are skipped
+IRAQ_LINK_RE = re.compile(r"/iraq/", re.IGNORECASE)
+IRAQ_PATH_RE = re.compile(IRAQ_LINK_RE.pattern.encode(), re.IGNORECASE)
+
+
+def filter_feed(feed_content: bytes) -> Optional[bytes]:
+    """Filter the feed to keep only Iraq-related articles
+
+    Returns None when the content is not an RSS feed, e.g. an HTML error page.
+    """
+    # Without /iraq/ anywhere in the feed every item is dropped unchecked
+    may_match = IRAQ_PATH_RE.search(feed_content) is not None
+
+    # Stream through the feed, dropping non-Iraq items as each one is parsed.
+    # The kept items are the original nodes, so their CDATA is untouched.
+    context = etree.iterparse(
+        BytesIO(feed_content),
+        events=("end",),
+        tag="item",
+        strip_cdata=False,
+        remove_blank_text=True,
+        recover=True,
+        resolve_entities=False,
+        no_network=True,
+        huge_tree=False,
+    )
 
-    # Add back only Iraq-related items
+    total_items = 0
     iraq_items = 0
-    for item in items:
-        link = item.find("link")
-        if link is not None and "/iraq/" in link.text.lower():
-            # Create new item with proper CDATA sections
-            new_item = etree.SubElement(channel, "item")
-
-            # Copy title and link
-            title = etree.SubElement(new_item, "title")
-            title.text = item.find("title").text
-            link_elem = etree.SubElement(new_item, "link")
-            link_elem.text = link.text
-
-            # Add creator with CDATA
-            creator = item.find("{http://purl.org/dc/elements/1.1/}creator")
-            if creator is not None:
-                create_cdata_element(
-                    "{http://purl.org/dc/elements/1.1/}creator",
-                    creator.text.strip(),
-                    new_item,
-                )
-
-            # Add publication date
-            pub_date = item.find("pubDate")
-            if pub_date is not None:
-                pub_date_elem = etree.SubElement(new_item, "pubDate")
-                pub_date_elem.text = pub_date.text
-
-            # Add categories with CDATA
-            for category in item.findall("category"):
-                create_cdata_element("category", category.text.strip(), new_item)
-
-            # Add guid
-            guid = item.find("guid")
-            if guid is not None:
-                guid_elem = etree.SubElement(new_item, "guid")
-                guid_elem.text = guid.text
-                if guid.get("isPermaLink"):
-                    guid_elem.set("isPermaLink", guid.get("isPermaLink"))
-
-            # Add description with CDATA
-            desc = item.find("description")
-            if desc is not None:
-                desc_text = (
-                    desc.text if desc.text else html.tostring(desc, encoding="unicode")
-                )
-                # Format description with proper newlines
-                formatted_desc = f"\n{desc_text.strip()}\n"
-                create_cdata_element("description", formatted_desc, new_item)
-
-            # Add content:encoded with CDATA
-            content = item.find("{http://purl.org/rss/1.0/modules/content/}encoded")
-            if content is not None:
-                content_text = (
-                    content.text
-                    if content.text
-                    else html.tostring(content, encoding="unicode")
-                )
-                # Format content with proper newlines
-                formatted_content = f"\n{content_text.strip()}\n"
-                create_cdata_element(
-                    "{http://purl.org/rss/1.0/modules/content/}encoded",
-                    formatted_content,
-                    new_item,
-                )
-
+    for _, item in context:
+        total_items += 1
+        if may_match and IRAQ_LINK_RE.search(item.findtext("link") or ""):
             iraq_items += 1
+        else:
+            item.getparent().remove(item)
+            item.clear()
+
+    root = context.root
+    if root is None or root.tag != "rss" or root.find("channel") is None:
+        logger.error("Invalid feed format: no rss channel found")
+        return None
 
     logger.info(
-        f"Filtered feed: {iraq_items} Iraq-related items out of {len(items)} total items"
+        "Filtered feed: %d Iraq-related items out of %d total items",
+        iraq_items,
+        total_items,
     )
 
-    # Convert back to string preserving CDATA and formatting
+    # Convert back to bytes preserving CDATA, without re-indenting
     return etree.tostring(
         root,
         encoding="utf-8",
         xml_declaration=True,
-        pretty_print=True,
         method="xml",
         with_tail=False,
-    ).decode("utf-8")
+    )
+
+
+def refresh_cache() -> None:
+    """Refresh the cached filtered feed, keeping the old copy on failure"""
+    try:
+        result = fetch_feed(_CACHE["upstream_etag"], _CACHE["upstream_last_modified"])
+        if result is None:
+            return
+        response, feed_content = result
+
+        if response.status_code == 304 and _CACHE["body"] is not None:
+            logger.info("Upstream feed not modified, reusing cached feed")
+            return
+
+        body = filter_feed(feed_content)
+        if body is None:
+            logger.error("Upstream returned an invalid feed, keeping cached feed")
+            return
+
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+        # Only recompress and move Last-Modified when the feed actually changed.
+        # Compression runs once per change, so use the highest levels.
+        if etag != _CACHE["etag"]:
+            now = datetime.now(timezone.utc).replace(microsecond=0)
+            encoded = {
+                "br": brotli.compress(body, quality=11),
+                "gzip": gzip.compress(body, compresslevel=9),
+            }
+            with _CACHE_LOCK:
+                _CACHE.update(
+                    etag=etag,
+                    last_modified=now,
+                    last_modified_header=http_date(now),
+                    body=body,
+                    encoded=encoded,
+                )
+
+        with _CACHE_LOCK:
+            _CACHE.update(
+                upstream_etag=response.headers.get("ETag"),
+                upstream_last_modified=response.headers.get("Last-Modified"),
+            )
+    except Exception:
+        logger.exception("Error refreshing feed")
+
+
+def feed_is_cached() -> bool:
+    """Whether a filtered feed is available to serve from memory"""
+    return _CACHE["body"] is not None
+
+
+def refresh_forever() -> None:
+    """Keep refreshing the cached feed, independently of client requests"""
+    while True:
+        refresh_cache()
+        _FIRST_REFRESH.set()
+        time.sleep(REFRESH_INTERVAL if feed_is_cached() else RETRY_INTERVAL)
 
 
 # Initialize Flask app
@@ -161,23 +242,60 @@ limiter = Limiter(
     storage_uri="memory://",
 )
 
+# Fill the cache and keep it fresh in the background, so a slow upstream
+# can't stall worker boot
+threading.Thread(target=refresh_forever, name="feed-refresh", daemon=True).start()
+
 
 @app.route("/")
-@limiter.limit("30 per minute")
+# Cached responses never reach upstream, so only rate limit while none exists
+@limiter.limit("30 per minute", exempt_when=feed_is_cached)
 def filtered_feed():
     """Main route handler for the filtered feed"""
     try:
-        # Fetch the original feed
-        feed_content = fetch_feed()
-        if feed_content is None:
-            return Response("Failed to fetch the RSS feed", status=503)
+        # A freshly started worker may still be running its first refresh
+        if not feed_is_cached():
+            _FIRST_REFRESH.wait(FETCH_TIMEOUT)
 
-        # Filter the feed
-        filtered_content = filter_feed(feed_content)
+        # Serve the last good feed from the background refresh
+        with _CACHE_LOCK:
+            body, etag = _CACHE["body"], _CACHE["etag"]
+            last_modified, encoded = _CACHE["last_modified"], _CACHE["encoded"]
+            last_modified_header = _CACHE["last_modified_header"]
+
+        if body is None:
+            return Response("Failed to fetch the RSS feed", status=503)
 
-        # Return the filtered feed
-        response = Response(filtered_content, mimetype="application/rss+xml")
-        response.headers["Cache-Control"] = "public, max-age=300"
+        # Pick a precompressed copy; each encoding gets its own
+        # "<etag>:<encoding>" validator
+        encoding = request.accept_encodings.best_match(list(encoded))
+        if encoding is not None:
+            body = encoded[encoding]
+
+        # Return the filtered feed, or 304 if the client already has it.
+        # As per RFC 9110, If-None-Match uses weak comparison and honours "*",
+        # and If-Modified-Since only applies without If-None-Match. The
+        # client's ETags are compared without the encoding suffix.
+        if request.if_none_match:
+            client_etags = {
+                tag.split(":")[0]
+                for tag in request.if_none_match.as_set(include_weak=True)
+            }
+            not_modified = request.if_none_match.star_tag or etag in client_etags
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and since >= last_modified
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/rss+xml")
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+        response.headers["Cache-Control"] = CACHE_CONTROL
+        response.headers["Vary"] = "Accept-Encoding"
+        response.set_etag(etag if encoding is None else f"{etag}:{encoding}")
+        response.headers["Last-Modified"] = last_modified_header
         return response
 
     except Exception as e: